@@ -15,12 +15,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from utils import convert_to_grayscale_async, fetch, fetch_image, parse_image_urls, save_image, follow_redirect
+from utils import (
+    NOT_MODIFIED,
+    BatchedWriter,
+    convert_and_save_grayscale_async,
+    convert_to_grayscale_async,
+    fetch,
+    fetch_image,
+    fetch_image_to_file,
+    load_cache_index,
+    parse_image_urls,
+    save_cache_index,
+)
 import aiohttp
 import argparse
 import asyncio
 import logging
 import os
+from urllib.parse import urlsplit
 
 
 """
@@ -33,78 +45,172 @@ __date__ = "20.06.2024"
 __version__ = "0.1.0"
 __emails__ = "noam.maissen@edu.hefr.ch, baptiste.roland@edu.hefr.ch"
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-async def scrape_images(url_list, dest_dir, convert_gray):
+DEFAULT_CONCURRENCY = 100  # Default cap on simultaneous HTTP requests
+
+# Image URLs already handled this process, so repeated thumbnails/logos are fetched once
+FETCHED = set()
+
+
+def make_session(concurrency=DEFAULT_CONCURRENCY):
+    """
+    Create a client session with a tuned connection pool.
+
+    :param concurrency: Maximum number of simultaneous connections
+    :type concurrency: int
+    :return: Configured aiohttp client session
+    :rtype: aiohttp.ClientSession
+    """
+    connector = aiohttp.TCPConnector(
+        limit=concurrency,
+        limit_per_host=8,
+        ttl_dns_cache=300,
+        enable_cleanup_closed=True,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60))
+
+
+async def warm_up_connections(session, url_list):
+    """
+    Issue one HEAD request per unique host to warm the DNS cache and connection pool.
+
+    Later requests reuse the keep-alive sockets, keeping the DNS + TCP + TLS
+    handshake out of the critical path. Failures are ignored.
+
+    :param session: Aiohttp client session
+    :type session: aiohttp.ClientSession
+    :param url_list: URLs about to be scraped
+    :type url_list: list
+    """
+    roots = {f"{s.scheme}://{s.netloc}/" for s in map(urlsplit, url_list) if s.scheme and s.netloc}
+
+    async def head(root):
+        async with session.head(root, allow_redirects=False):
+            pass
+
+    if roots:
+        logger.info("Warming connections to %d hosts", len(roots))
+        await asyncio.gather(*(head(root) for root in roots), return_exceptions=True)
+
+
+async def scrape_images(url_list, dest_dir, convert_gray, concurrency=DEFAULT_CONCURRENCY, session=None):
     """
     Scrape images from a list of URLs and save them to the destination directory.
 
+    Callers invoking this function many times should pass their own session so the
+    connection pool and DNS cache are reused across runs; it is then left open.
+
     :param url_list: List of URLs to scrape images from
     :type url_list: list
     :param dest_dir: Directory to save the downloaded images
     :type dest_dir: str
     :param convert_gray: Flag to indicate if images should be converted to grayscale
     :type convert_gray: bool
+    :param concurrency: Maximum number of simultaneous HTTP requests
+    :type concurrency: int
+    :param session: Optional aiohttp client session to reuse; a new one is created if None
+    :type session: aiohttp.ClientSession or None
     """
-    async with aiohttp.ClientSession() as session:
+    os.makedirs(dest_dir, exist_ok=True)  # Create the destination directory once for the whole run
+    sem = asyncio.Semaphore(concurrency)  # Bound the number of in-flight requests
+    cache_index = load_cache_index(dest_dir)  # Validators from previous runs
+    owns_session = session is None
+    if owns_session:
+        session = make_session(concurrency)
+    try:
+        await warm_up_connections(session, url_list)  # Hide cold-start handshake latency
         tasks = []
         for url in url_list:
-            tasks.append(process_url(session, url, dest_dir, convert_gray))
+            tasks.append(process_url(session, sem, url, dest_dir, convert_gray, cache_index))
         await asyncio.gather(*tasks)
+    finally:
+        save_cache_index(dest_dir, cache_index)
+        if owns_session:  # Only close sessions we created ourselves
+            await session.close()
 
 
-async def process_url(session, url, dest_dir, convert_gray):
+async def process_url(session, sem, url, dest_dir, convert_gray, cache_index=None):
     """
     Process a single URL to fetch and download images.
 
     :param session: Aiohttp client session
     :type session: aiohttp.ClientSession
+    :param sem: Semaphore bounding concurrent HTTP requests
+    :type sem: asyncio.Semaphore
     :param url: URL to process
     :type url: str
     :param dest_dir: Directory to save the downloaded images
     :type dest_dir: str
     :param convert_gray: Flag to indicate if images should be converted to grayscale
     :type convert_gray: bool
+    :param cache_index: Optional mapping of URL to cached validators from previous runs
+    :type cache_index: dict or None
     """
-    logger.info(f"Processing URL: {url}")
-    redirected_url = await follow_redirect(session, url)  # Follow the redirection
-    html = await fetch(session, redirected_url)  # Fetch the HTML content
+    logger.info("Processing URL: %s", url)
+    async with sem:
+        html, final_url = await fetch(session, url)  # Fetch the HTML content, following redirects
     if not html:
-        logger.warning(f"No HTML content fetched for URL: {redirected_url}")
+        logger.warning("No HTML content fetched for URL: %s", final_url)
         return
-    image_urls = await parse_image_urls(html, redirected_url)
-    if not os.path.exists(dest_dir):  # Create the destination directory if it does not exist
-        os.makedirs(dest_dir)
+    image_urls = await parse_image_urls(html, final_url)
+    writer = BatchedWriter()  # Aggregate this page's small writes into batched disk flushes
     tasks = []
     for img_url in image_urls:  # Download and save each image
-        tasks.append(download_and_save_image(session, img_url, dest_dir, convert_gray))
+        tasks.append(download_and_save_image(session, sem, img_url, dest_dir, convert_gray, cache_index, writer))
     await asyncio.gather(*tasks)
+    await writer.flush()  # Write out any remainder below the batch threshold
 
 
-async def download_and_save_image(session, img_url, dest_dir, convert_gray):
+async def download_and_save_image(session, sem, img_url, dest_dir, convert_gray, cache_index=None, writer=None):
     """
     Download an image and save it to the destination directory.
 
+    URLs already downloaded in this process are skipped, and when a cache index
+    is given an unchanged image (304 Not Modified) is not re-downloaded.
+
     :param session: Aiohttp client session
     :type session: aiohttp.ClientSession
+    :param sem: Semaphore bounding concurrent HTTP requests
+    :type sem: asyncio.Semaphore
     :param img_url: Image URL to download
     :type img_url: str
     :param dest_dir: Directory to save the downloaded image
     :type dest_dir: str
     :param convert_gray: Flag to indicate if image should be converted to grayscale
     :type convert_gray: bool
+    :param cache_index: Optional mapping of URL to cached validators from previous runs
+    :type cache_index: dict or None
+    :param writer: Optional batched writer to aggregate small grayscale writes
+    :type writer: utils.BatchedWriter or None
     """
-    logger.info(f"Downloading image URL: {img_url}")
-    image_data, updated_url = await fetch_image(session, img_url)
+    if img_url in FETCHED:  # Same thumbnail/logo linked from several pages
+        logger.debug("Skipping already fetched image URL: %s", img_url)
+        return
+    FETCHED.add(img_url)
+    logger.debug("Downloading image URL: %s", img_url)
+    if not convert_gray:  # Stream the body straight to disk without buffering the whole image
+        async with sem:
+            filepath = await fetch_image_to_file(session, img_url, dest_dir, cache_index)
+        if not filepath:
+            logger.warning("No image data fetched for URL: %s", img_url)
+        return
+    async with sem:  # Grayscale needs the whole buffer in memory for Pillow
+        image_data, updated_url = await fetch_image(session, img_url, cache_index)
+    if image_data is NOT_MODIFIED:  # Converted file from a previous run is still current
+        return
     if not image_data:
-        logger.warning(f"No image data fetched for URL: {img_url}")
+        logger.warning("No image data fetched for URL: %s", img_url)
         return
-    if convert_gray:  # Convert the image to grayscale
-        image_data = await convert_to_grayscale_async(image_data)
     filename = os.path.join(dest_dir, os.path.basename(updated_url))  # Save the image to the destination directory
-    await save_image(image_data, filename)
+    if writer is not None:  # Convert in the pool, then let the writer batch the disk write
+        image_data = await convert_to_grayscale_async(image_data)
+        await writer.add(filename, image_data)
+    else:
+        await convert_and_save_grayscale_async(image_data, filename)
+    if cache_index is not None and img_url in cache_index:
+        cache_index[img_url]["path"] = filename  # Point the index entry at the converted file
 
 
 def load_urls(file_path):
@@ -119,10 +225,10 @@ def load_urls(file_path):
     try:
         with open(file_path, "r") as file:  # Read the URLs from the file
             urls = [line.strip() for line in file.readlines()]
-        logger.info(f"Loaded {len(urls)} URLs from {file_path}")
+        logger.info("Loaded %d URLs from %s", len(urls), file_path)
         return urls
     except Exception as e:
-        logger.error(f"Error loading URLs from {file_path}: {e}")
+        logger.error("Error loading URLs from %s: %s", file_path, e)
         return []
 
 
@@ -134,10 +240,14 @@ def main():
     parser.add_argument("--URLlist", type=str, default="./urls.txt", help="File containing the URL list")
     parser.add_argument("--nc", action="store_true", help="Do not convert images to grayscale")
     parser.add_argument("--dest", type=str, default="../images", help="Destination directory for downloaded images")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Maximum number of simultaneous HTTP requests")
+    parser.add_argument("--verbose", action="store_true", help="Enable per-image debug logging")
     args = parser.parse_args()
 
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
     url_list = load_urls(args.URLlist)
-    asyncio.run(scrape_images(url_list, args.dest, not args.nc))
+    asyncio.run(scrape_images(url_list, args.dest, not args.nc, args.concurrency))
 
 
 if __name__ == "__main__":
@@ -15,12 +15,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import aiohttp
 import argparse
 import asyncio
+import logging
 import os
-from bs4 import BeautifulSoup
-from image_scraper import download_and_save_image, follow_redirect, fetch, parse_image_urls
+from selectolax.parser import HTMLParser
+from image_scraper import DEFAULT_CONCURRENCY, download_and_save_image, fetch, make_session
+from utils import load_cache_index, parse_image_urls_from_doc, save_cache_index
+
+logger = logging.getLogger(__name__)
 
 async def fetch_album_urls(session, base_url):
     """
@@ -34,24 +37,109 @@ async def fetch_album_urls(session, base_url):
     :rtype: list of tuples
     """
     album_urls = []
-    html = await fetch(session, base_url)
-    soup = BeautifulSoup(html, 'html.parser')
-    category_links = soup.select('dl#mbCategories ul li a')
-    
+    html, _ = await fetch(session, base_url)  # The category page is a single request, no semaphore needed
+    doc = HTMLParser(html)
+    category_links = doc.css('dl#mbCategories ul li a')
+
     for link in category_links:
-        album_url = link.get('href')
-        album_title = link.get_text(strip=True)
+        album_url = link.attributes.get('href')
+        album_title = link.text(strip=True)
         album_urls.append((album_url, album_title))
     
     return album_urls
 
-async def scrape_album_images_bfs(session, base_url, album_url, album_title, dest_dir, max_depth=2):
+async def scrape_album(session, sem, base_url, queue, current_url, current_title, current_dir, current_depth, max_depth,
+                       cache_index=None, created_dirs=None):
+    """
+    Scrape all pages of a single album and enqueue its sub-albums for the BFS workers.
+
+    :param session: Aiohttp client session
+    :type session: aiohttp.ClientSession
+    :param sem: Semaphore bounding concurrent HTTP requests
+    :type sem: asyncio.Semaphore
+    :param base_url: The base URL of the site
+    :type base_url: str
+    :param queue: BFS queue to push discovered sub-albums into
+    :type queue: asyncio.Queue
+    :param current_url: The relative URL of the album
+    :type current_url: str
+    :param current_title: The title of the album
+    :type current_title: str
+    :param current_dir: Parent directory for this album's folder
+    :type current_dir: str
+    :param current_depth: Current BFS depth of this album
+    :type current_depth: int
+    :param max_depth: Maximum depth to avoid excessive recursion
+    :type max_depth: int
+    :param cache_index: Optional mapping of URL to cached validators from previous runs
+    :type cache_index: dict or None
+    :param created_dirs: Directories already created this BFS, to skip repeat stat calls
+    :type created_dirs: set or None
+    """
+    full_album_url = os.path.join(base_url, current_url)
+
+    # Generate unique directory for each album, creating it only once per BFS
+    album_dest_dir = os.path.join(current_dir, current_title.replace(' ', '_'))
+    if created_dirs is None or album_dest_dir not in created_dirs:
+        os.makedirs(album_dest_dir, exist_ok=True)
+        if created_dirs is not None:
+            created_dirs.add(album_dest_dir)
+
+    async def fetch_page(page_url):
+        async with sem:
+            return await fetch(session, page_url)  # Fetch the page, following redirects
+
+    doc = None
+    next_task = asyncio.create_task(fetch_page(full_album_url))
+    while next_task is not None:
+        html, final_url = await next_task
+        next_task = None
+
+        if not html:
+            # Log the issue and break the loop if HTML is not fetched
+            logger.warning("Failed to fetch HTML from %s", final_url)
+            break
+
+        # Parse the page once and reuse the document for every selector below
+        doc = HTMLParser(html)
+
+        # Start fetching the next page (if any) while this page's images download
+        next_page_link = doc.css_first('span.navPrevNext a[rel="next"]')  # Selector for the "Next" link
+        if next_page_link and next_page_link.attributes.get('href'):
+            next_url = os.path.join(base_url, next_page_link.attributes.get('href'))
+            next_task = asyncio.create_task(fetch_page(next_url))
+
+        # Download images in the current page of the album
+        image_urls = parse_image_urls_from_doc(doc, final_url)
+        tasks = [download_and_save_image(session, sem, img_url, album_dest_dir, False, cache_index)
+                 for img_url in image_urls]
+        await asyncio.gather(*tasks)
+
+    # Avoid further processing if maximum depth is reached
+    if doc is None or current_depth >= max_depth:
+        return
+
+    # Find and queue sub-albums from the last fetched page
+    sub_album_links = doc.css('ul ul li a')  # Select only nested sub-albums
+    for sub_album_link in sub_album_links:
+        sub_album_url = sub_album_link.attributes.get('href')
+        if not sub_album_url:  # Skip anchors without a target, as the next-page check does
+            continue
+        sub_album_title = sub_album_link.text(strip=True)
+        queue.put_nowait((sub_album_url, sub_album_title, album_dest_dir, current_depth + 1))
+
+
+async def scrape_album_images_bfs(session, sem, base_url, album_url, album_title, dest_dir, max_depth=2, num_workers=8,
+                                  cache_index=None):
     """
     Scrape images from albums using breadth-first search and save them to a designated folder,
-    handling pagination for albums that span multiple pages.
+    handling pagination for albums that span multiple pages. Albums are processed by a pool
+    of worker coroutines so several albums are in flight at once.
 
     :param session: Aiohttp client session
     :type session: aiohttp.ClientSession
+    :param sem: Semaphore bounding concurrent HTTP requests
+    :type sem: asyncio.Semaphore
     :param base_url: The base URL of the site
     :type base_url: str
     :param album_url: The relative URL of the album
@@ -62,75 +150,74 @@ async def scrape_album_images_bfs(session, base_url, album_url, album_title, des
     :type dest_dir: str
     :param max_depth: Maximum depth to avoid excessive recursion
     :type max_depth: int
+    :param num_workers: Number of worker coroutines draining the BFS queue
+    :type num_workers: int
+    :param cache_index: Optional mapping of URL to cached validators from previous runs
+    :type cache_index: dict or None
     """
     visited = set()
-    queue = [(album_url, album_title, dest_dir, 0)]  # Initialize the queue with the root album
-
-    while queue:
-        current_url, current_title, current_dir, current_depth = queue.pop(0)
-
-        # Avoid revisiting the same album
-        full_album_url = os.path.join(base_url, current_url)
-        if full_album_url in visited:
-            continue
-        visited.add(full_album_url)
-
-        # Generate unique directory for each album
-        album_dest_dir = os.path.join(current_dir, current_title.replace(' ', '_'))
-        if not os.path.exists(album_dest_dir):
-            os.makedirs(album_dest_dir)
-
-        while full_album_url:
-            redirected_url = await follow_redirect(session, full_album_url)
-            html = await fetch(session, redirected_url)
-
-            if not html:
-                # Log the issue and break the loop if HTML is not fetched
-                print(f"Failed to fetch HTML from {full_album_url}")
-                break
-
-            # Parse and download images in the current page of the album
-            image_urls = await parse_image_urls(html, redirected_url)
-            tasks = [download_and_save_image(session, img_url, album_dest_dir, False) for img_url in image_urls]
-            await asyncio.gather(*tasks)
-
-            # Find and queue the next page if available
-            soup = BeautifulSoup(html, 'html.parser')
-            next_page_link = soup.select_one('span.navPrevNext a[rel="next"]')  # Selector for the "Next" link
-            if next_page_link and next_page_link.get('href'):
-                full_album_url = os.path.join(base_url, next_page_link.get('href'))
-            else:
-                full_album_url = None
-
-        # Avoid further processing if maximum depth is reached
-        if current_depth >= max_depth:
-            continue
-
-        # Find and queue sub-albums
-        soup = BeautifulSoup(html, 'html.parser')
-        sub_album_links = soup.select('ul ul li a')  # Select only nested sub-albums
-        for sub_album_link in sub_album_links:
-            sub_album_url = sub_album_link.get('href')
-            sub_album_title = sub_album_link.get_text(strip=True)
-            queue.append((sub_album_url, sub_album_title, album_dest_dir, current_depth + 1))
-
-
-async def download_scout(dest_dir, base_url):
+    created_dirs = set()  # Album directories already created this BFS
+    queue = asyncio.Queue()
+    queue.put_nowait((album_url, album_title, dest_dir, 0))  # Initialize the queue with the root album
+
+    async def worker():
+        while True:
+            current_url, current_title, current_dir, current_depth = await queue.get()
+            try:
+                # Avoid revisiting the same album
+                full_album_url = os.path.join(base_url, current_url)
+                if full_album_url not in visited:
+                    visited.add(full_album_url)
+                    await scrape_album(session, sem, base_url, queue,
+                                       current_url, current_title, current_dir, current_depth, max_depth,
+                                       cache_index, created_dirs)
+            except Exception as e:
+                # Keep the worker alive: a failing album must not kill the pool
+                # and leave queue.join() waiting forever
+                logger.error("Error scraping album %s: %s", current_url, e)
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(num_workers)]
+    await queue.join()  # Wait until every queued album has been processed
+    for w in workers:
+        w.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+
+async def download_scout(dest_dir, base_url, concurrency=DEFAULT_CONCURRENCY, session=None):
     """
     Download images from all albums on the category page, including nested sub-albums.
 
+    Callers invoking this function many times should pass their own session so the
+    connection pool and DNS cache are reused across runs; it is then left open.
+
     :param dest_dir: Destination directory for downloaded images
     :type dest_dir: str
     :param base_url: Base URL of the category page
     :type base_url: str
+    :param concurrency: Maximum number of simultaneous HTTP requests
+    :type concurrency: int
+    :param session: Optional aiohttp client session to reuse; a new one is created if None
+    :type session: aiohttp.ClientSession or None
     """
-    async with aiohttp.ClientSession() as session:
+    sem = asyncio.Semaphore(concurrency)  # Bound the number of in-flight requests
+    cache_index = load_cache_index(dest_dir)  # Validators from previous runs
+    owns_session = session is None
+    if owns_session:
+        session = make_session(concurrency)
+    try:
         album_urls = await fetch_album_urls(session, base_url)
         tasks = []
         for album_url, album_title in album_urls:
             # Use the destination directory to manage each top-level album
-            tasks.append(scrape_album_images_bfs(session, base_url, album_url, album_title, dest_dir))
+            tasks.append(scrape_album_images_bfs(session, sem, base_url, album_url, album_title, dest_dir,
+                                                 cache_index=cache_index))
         await asyncio.gather(*tasks)
+    finally:
+        save_cache_index(dest_dir, cache_index)
+        if owns_session:  # Only close sessions we created ourselves
+            await session.close()
 
 def main():
     """
@@ -139,9 +226,13 @@ def main():
     parser = argparse.ArgumentParser(description="Asyncio Website Image Scraper for Albums")
     parser.add_argument("--base_url", type=str, default="https://foto.scoutlocarno.ch/", help="Base URL of the site")
     parser.add_argument("--dest", type=str, default="../images", help="Destination directory for downloaded images")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Maximum number of simultaneous HTTP requests")
+    parser.add_argument("--verbose", action="store_true", help="Enable per-image debug logging")
     args = parser.parse_args()
 
-    asyncio.run(download_scout(args.dest, args.base_url))
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    asyncio.run(download_scout(args.dest, args.base_url, args.concurrency))
 
 if __name__ == "__main__":
     main()
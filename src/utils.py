@@ -16,12 +16,16 @@
 # limitations under the License.
 
 import asyncio
+import atexit
+import functools
 from concurrent.futures import ThreadPoolExecutor
-from bs4 import BeautifulSoup
+from selectolax.parser import HTMLParser
 from PIL import Image, UnidentifiedImageError
-from urllib.parse import urljoin, urlparse
+from urllib.parse import urljoin
 import aiofiles
 import io
+import json
+import numpy as np
 import os
 import logging
 
@@ -36,51 +40,87 @@ __version__ = "0.1.0"
 __emails__ = "noam.maissen@edu.hefr.ch, baptiste.roland@edu.hefr.ch"
 __name__ = "image_scraper"
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Shared executor for CPU-bound image work, reused across all conversions
+_GRAY_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="gray")
+atexit.register(_GRAY_POOL.shutdown)
 
-async def follow_redirect(session, url):
-    """
-    Follow redirects for a given URL and return the final URL.
+# Shared executor for blocking disk writes, kept separate so slow I/O
+# never starves the conversion pool
+_IO_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="io")
+atexit.register(_IO_POOL.shutdown)
 
-    :param session: Aiohttp client session
-    :type session: aiohttp.ClientSession
-    :param url: Initial URL to follow
-    :type url: str
-    :return: Final redirected URL
-    :rtype: str
+
+# In-flight requests keyed by (function, URL); later callers await the first result
+_IN_FLIGHT = {}
+
+
+def _coalesce(fn):
     """
-    try:
-        async with session.get(url) as response:
-            response.raise_for_status()  # Raise exception for HTTP errors
-            redirected_url = str(response.url)
-            logger.info(f"Redirected URL: {redirected_url}")
-            return redirected_url
-    except Exception as e:
-        logger.error(f"Error following redirection {url}: {e}")
-        return url
+    Share the result of concurrent calls for the same URL.
 
+    If a second task asks for a URL that is already being fetched, it awaits
+    the first task's future instead of issuing a duplicate request. Entries
+    are removed as soon as the request completes.
 
+    :param fn: Coroutine function taking (session, url, ...) to wrap
+    :type fn: callable
+    :return: Wrapped coroutine function
+    :rtype: callable
+    """
+    @functools.wraps(fn)
+    async def wrapper(session, url, *args, **kwargs):
+        key = (fn.__name__, url)
+        fut = _IN_FLIGHT.get(key)
+        if fut is not None:
+            return await fut  # Another task is already fetching this URL
+        fut = asyncio.get_running_loop().create_future()
+        _IN_FLIGHT[key] = fut
+        try:
+            result = await fn(session, url, *args, **kwargs)
+            fut.set_result(result)
+            return result
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            _IN_FLIGHT.pop(key, None)
+    return wrapper
+
+
+@_coalesce
 async def fetch(session, url):
     """
-    Fetch the HTML content from a given URL.
+    Fetch the HTML content from a given URL, following redirects.
 
     :param session: Aiohttp client session
     :type session: aiohttp.ClientSession
     :param url: URL to fetch
     :type url: str
-    :return: HTML content of the URL
-    :rtype: str or None
+    :return: HTML content and the final URL after redirects
+    :rtype: tuple (str or None, str)
     """
     try:
-        async with session.get(url) as response:
+        async with session.get(url, allow_redirects=True) as response:
             response.raise_for_status()  # Raise exception for HTTP errors
-            logger.info(f"Successfully fetched URL: {url}")
-            return await response.text()
+            final_url = str(response.url)
+            logger.debug("Successfully fetched URL: %s", final_url)
+            return await response.text(), final_url
     except Exception as e:
-        logger.error(f"Error fetching {url}: {e}")
-        return None
+        logger.error("Error fetching %s: %s", url, e)
+        return None, url
+
+
+# Extension lookup by MIME type: one hash probe instead of chained substring scans
+_CT_EXT = {
+    "image/jpeg": ".jpg",
+    "image/jpg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/bmp": ".bmp",
+    "image/webp": ".webp",
+}
 
 
 def get_extension_from_content_type(content_type):
@@ -92,18 +132,7 @@ def get_extension_from_content_type(content_type):
     :return: File extension based on the content type
     :rtype: str or None
     """
-    if "jpeg" in content_type or "jpg" in content_type:
-        return ".jpg"
-    elif "png" in content_type:
-        return ".png"
-    elif "gif" in content_type:
-        return ".gif"
-    elif "bmp" in content_type:
-        return ".bmp"
-    elif "webp" in content_type:
-        return ".webp"
-    else:
-        return None
+    return _CT_EXT.get(content_type.split(";", 1)[0].strip().lower())
 
 
 def add_extension_if_missing(url, content_type):
@@ -117,78 +146,318 @@ def add_extension_if_missing(url, content_type):
     :return: Updated URL with the correct file extension
     :rtype: str
     """
-    parsed_url = urlparse(url)
-    extension = os.path.splitext(parsed_url.path)[1]
-    if not extension:
+    path = url.split("?", 1)[0]  # Cheaper than a full urlparse for an extension check
+    if "." not in path.rsplit("/", 1)[-1]:
         new_extension = get_extension_from_content_type(content_type)
         if new_extension:
             url += new_extension
-            logger.info(f"Added extension {new_extension} to URL: {url}")
+            logger.debug("Added extension %s to URL: %s", new_extension, url)
     return url
 
 
-async def fetch_image(session, url):
+# Name of the on-disk index mapping URL -> validators, stored in the destination directory
+CACHE_INDEX_FILE = ".cache_index.json"
+
+# Sentinel returned when a conditional request was answered with 304 Not Modified
+NOT_MODIFIED = object()
+
+
+def load_cache_index(dest_dir):
+    """
+    Load the URL cache index from the destination directory.
+
+    :param dest_dir: Directory the index is stored in
+    :type dest_dir: str
+    :return: Mapping of URL to {"etag": ..., "lm": ..., "path": ...}
+    :rtype: dict
+    """
+    filepath = os.path.join(dest_dir, CACHE_INDEX_FILE)
+    try:
+        with open(filepath, "r") as file:
+            index = json.load(file)
+        logger.info("Loaded cache index with %d entries from %s", len(index), filepath)
+        return index
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache_index(dest_dir, cache_index):
+    """
+    Save the URL cache index to the destination directory.
+
+    :param dest_dir: Directory to store the index in
+    :type dest_dir: str
+    :param cache_index: Mapping of URL to {"etag": ..., "lm": ..., "path": ...}
+    :type cache_index: dict
+    """
+    try:
+        os.makedirs(dest_dir, exist_ok=True)
+        with open(os.path.join(dest_dir, CACHE_INDEX_FILE), "w") as file:
+            json.dump(cache_index, file)
+    except OSError as e:
+        logger.error("Error saving cache index to %s: %s", dest_dir, e)
+
+
+def _conditional_headers(cache_index, url):
+    """
+    Build If-None-Match/If-Modified-Since headers for a URL from the cache index.
+
+    Validators are only sent when the previously saved file still exists on
+    disk; a 304 answer is useless without a local copy to fall back on, so in
+    that case a full re-fetch is forced instead.
+
+    :param cache_index: Mapping of URL to cached validators, or None
+    :type cache_index: dict or None
+    :param url: URL about to be fetched
+    :type url: str
+    :return: Conditional request headers (possibly empty)
+    :rtype: dict
+    """
+    headers = {}
+    entry = cache_index.get(url) if cache_index is not None else None
+    if entry and entry.get("path") and os.path.isfile(entry["path"]):
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("lm"):
+            headers["If-Modified-Since"] = entry["lm"]
+    return headers
+
+
+def _record_validators(cache_index, url, response, filepath):
+    """
+    Remember a response's ETag/Last-Modified validators in the cache index.
+
+    :param cache_index: Mapping of URL to cached validators, or None
+    :type cache_index: dict or None
+    :param url: URL the response belongs to
+    :type url: str
+    :param response: Aiohttp response the image came from
+    :type response: aiohttp.ClientResponse
+    :param filepath: Path the image was (or will be) saved to
+    :type filepath: str or None
+    """
+    if cache_index is not None:
+        cache_index[url] = {
+            "etag": response.headers.get("ETag"),
+            "lm": response.headers.get("Last-Modified"),
+            "path": filepath,
+        }
+
+
+@_coalesce
+async def fetch_image(session, url, cache_index=None):
     """
     Fetch image data from a given URL.
 
+    When a cache index is given, a conditional request is sent and NOT_MODIFIED
+    is returned in place of the data if the server answers 304.
+
     :param session: Aiohttp client session
     :type session: aiohttp.ClientSession
     :param url: URL to fetch the image from
     :type url: str
-    :return: Image data and updated URL with extension
+    :param cache_index: Optional mapping of URL to cached validators
+    :type cache_index: dict or None
+    :return: Image data and final URL with extension
     :rtype: tuple (bytes, str)
     """
     try:
-        async with session.get(url) as response:
+        headers = _conditional_headers(cache_index, url)
+        async with session.get(url, allow_redirects=True, headers=headers) as response:
+            if response.status == 304:
+                logger.debug("Image not modified since last run: %s", url)
+                return NOT_MODIFIED, url
             response.raise_for_status()  # Raise exception for HTTP errors
             content_type = response.content_type
             if "image" in content_type:
-                url = add_extension_if_missing(url, content_type)
-                logger.info(f"Successfully fetched image URL: {url} with content type {content_type}")
-                return await response.read(), url
+                final_url = add_extension_if_missing(str(response.url), content_type)
+                data = await response.read()
+                # Record validators only once the body arrived in full, so a dropped
+                # connection never leaves an entry that later 304s against nothing
+                _record_validators(cache_index, url, response, None)
+                logger.debug("Successfully fetched image URL: %s with content type %s", final_url, content_type)
+                return data, final_url
             else:
                 content_snippet = await response.text()
                 logger.warning(
-                    f"Non-image content type at {url}: {content_type}, content snippet: {content_snippet[:100]}"
+                    "Non-image content type at %s: %s, content snippet: %s", url, content_type, content_snippet[:100]
                 )
                 return None, url
     except Exception as e:
-        logger.error(f"Error fetching image {url}: {e}")
+        logger.error("Error fetching image %s: %s", url, e)
         return None, url
 
 
-async def parse_image_urls(html, base_url):
+async def fetch_image_to_file(session, url, dest_dir, cache_index=None):
     """
-    Parse image URLs from the HTML content, excluding unwanted images.
+    Stream an image from a URL directly into a file in the destination directory.
 
-    :param html: HTML content of the page
-    :type html: str
+    The response body is written chunk by chunk, so peak memory stays at the
+    chunk size instead of the full image size. When a cache index is given, a
+    conditional request is sent and the previously saved path is returned if
+    the server answers 304.
+
+    :param session: Aiohttp client session
+    :type session: aiohttp.ClientSession
+    :param url: URL to fetch the image from
+    :type url: str
+    :param dest_dir: Directory to save the downloaded image
+    :type dest_dir: str
+    :param cache_index: Optional mapping of URL to cached validators
+    :type cache_index: dict or None
+    :return: Path of the saved file, or None on failure
+    :rtype: str or None
+    """
+    try:
+        headers = _conditional_headers(cache_index, url)
+        async with session.get(url, allow_redirects=True, headers=headers) as response:
+            if response.status == 304:
+                logger.debug("Image not modified since last run: %s", url)
+                return cache_index[url].get("path")
+            response.raise_for_status()  # Raise exception for HTTP errors
+            content_type = response.content_type
+            if "image" not in content_type:
+                content_snippet = await response.text()
+                logger.warning(
+                    "Non-image content type at %s: %s, content snippet: %s", url, content_type, content_snippet[:100]
+                )
+                return None
+            final_url = add_extension_if_missing(str(response.url), content_type)
+            filepath = os.path.join(dest_dir, os.path.basename(final_url))
+            async with aiofiles.open(filepath, "wb") as file:
+                async for chunk in response.content.iter_chunked(65536):
+                    await file.write(chunk)
+            _record_validators(cache_index, url, response, filepath)
+            logger.debug("Successfully streamed image URL: %s to %s", url, filepath)
+            return filepath
+    except Exception as e:
+        logger.error("Error fetching image %s: %s", url, e)
+        return None
+
+
+def parse_image_urls_from_doc(doc, base_url):
+    """
+    Extract image URLs from an already parsed document, excluding unwanted images.
+
+    Callers that also run other selectors on the same page should parse once
+    and use this instead of parse_image_urls to avoid re-parsing the HTML.
+
+    :param doc: Parsed HTML document
+    :type doc: selectolax.parser.HTMLParser
     :param base_url: Base URL of the page to resolve relative URLs
     :type base_url: str
     :return: List of full image URLs
     :rtype: list
     """
-    soup = BeautifulSoup(html, "html.parser")
     image_urls = []
     unwanted_patterns = ['ajax_loader.gif']  # Add more patterns if needed
 
-    for img in soup.find_all("img"):
-        src = img.get("src")
+    for img in doc.css("img"):
+        src = img.attributes.get("src")
         if src:
-            full_url = urljoin(base_url, src)
+            if src.startswith(("http://", "https://")):  # Already absolute, skip the urljoin
+                full_url = src
+            else:
+                full_url = urljoin(base_url, src)
             # Skip unwanted images based on patterns
             if any(pattern in full_url for pattern in unwanted_patterns):
-                logger.info(f"Skipped unwanted image URL: {full_url}")
+                logger.debug("Skipped unwanted image URL: %s", full_url)
                 continue
             image_urls.append(full_url)
 
-    logger.info(f"Found {len(image_urls)} image URLs on {base_url}")
+    logger.debug("Found %d image URLs on %s", len(image_urls), base_url)
     return image_urls
 
 
+async def parse_image_urls(html, base_url):
+    """
+    Parse image URLs from the HTML content, excluding unwanted images.
+
+    :param html: HTML content of the page
+    :type html: str
+    :param base_url: Base URL of the page to resolve relative URLs
+    :type base_url: str
+    :return: List of full image URLs
+    :rtype: list
+    """
+    doc = HTMLParser(html)  # selectolax parses in C, far faster than BeautifulSoup here
+    return parse_image_urls_from_doc(doc, base_url)
+
+
+def _write_batch(batch):
+    """
+    Write a batch of (filepath, data) pairs to disk synchronously.
+
+    :param batch: Pairs of file path and image data to write
+    :type batch: list of tuples
+    """
+    for filepath, data in batch:
+        try:
+            with open(filepath, "wb") as file:
+                file.write(data)
+        except OSError as e:
+            logger.error("Error saving image to %s: %s", filepath, e)
+
+
+class BatchedWriter:
+    """
+    Aggregate many small file writes into one thread-pool task per batch.
+
+    Pending (path, data) pairs are flushed in a single executor hop once 32
+    items or 4 MB accumulate, amortizing the per-file syscall and thread
+    handoff cost for syscall-dominated thumbnail writes. Callers must await
+    flush() when done to write out any remainder.
+    """
+
+    MAX_ITEMS = 32
+    MAX_BYTES = 4 * 1024 * 1024
+
+    def __init__(self):
+        self._pending = []
+        self._pending_bytes = 0
+
+    async def add(self, filepath, data):
+        """
+        Queue image data for writing, flushing if the batch is full.
+
+        :param filepath: Path to save the image
+        :type filepath: str
+        :param data: Image data to save
+        :type data: bytes
+        """
+        self._pending.append((filepath, data))
+        self._pending_bytes += len(data)
+        if len(self._pending) >= self.MAX_ITEMS or self._pending_bytes >= self.MAX_BYTES:
+            await self.flush()
+
+    async def flush(self):
+        """
+        Write all pending images to disk in a single thread-pool task.
+        """
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        self._pending_bytes = 0
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(_IO_POOL, _write_batch, batch)
+
+
+def _sync_write(filepath, data):
+    """
+    Write data to a file synchronously.
+
+    :param filepath: Path to write to
+    :type filepath: str
+    :param data: Data to write
+    :type data: bytes
+    """
+    with open(filepath, "wb") as file:
+        file.write(data)
+
+
 async def save_image(data, filepath):
     """
-    Save image data to a file.
+    Save image data to a file via the shared I/O thread pool.
 
     :param data: Image data to save
     :type data: bytes
@@ -196,11 +465,42 @@ async def save_image(data, filepath):
     :type filepath: str
     """
     try:
-        async with aiofiles.open(filepath, "wb") as file:
-            await file.write(data)
-        logger.info(f"Successfully saved image to {filepath}")
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(_IO_POOL, _sync_write, filepath, data)
+        logger.debug("Successfully saved image to %s", filepath)
     except Exception as e:
-        logger.error(f"Error saving image to {filepath}: {e}")
+        logger.error("Error saving image to %s: %s", filepath, e)
+
+
+# Rec. 601 luminance weights in 8-bit fixed point; the dot product stays within uint16
+_LUMA_WEIGHTS = np.array([76, 150, 29], dtype=np.uint16)
+
+# Below this pixel count the NumPy round-trip costs more than Pillow's convert()
+_NUMPY_GRAY_THRESHOLD = 1_000_000
+
+
+def _grayscale(image):
+    """
+    Convert an open Pillow image to grayscale using its fastest decode path.
+
+    For JPEGs, draft() asks libjpeg to decode directly as grayscale, and the
+    alpha channel is only kept when the source actually has one. Large RGB
+    images take a vectorized NumPy fixed-point dot product instead of
+    Pillow's per-pixel convert().
+
+    :param image: Open Pillow image
+    :type image: PIL.Image.Image
+    :return: Grayscale image
+    :rtype: PIL.Image.Image
+    """
+    if image.format == "JPEG":
+        image.draft("L", image.size)  # Decode as grayscale inside libjpeg
+    if image.mode == "RGB" and image.width * image.height > _NUMPY_GRAY_THRESHOLD:
+        arr = np.asarray(image, dtype=np.uint8)
+        gray = ((arr @ _LUMA_WEIGHTS) >> 8).astype(np.uint8)  # Integer dot, no float pass
+        return Image.fromarray(gray, "L")
+    mode = "LA" if "A" in image.getbands() else "L"
+    return image.convert(mode)
 
 
 def convert_to_grayscale(image_data):
@@ -214,13 +514,13 @@ def convert_to_grayscale(image_data):
     """
     try:
         image = Image.open(io.BytesIO(image_data))
-        gray_image = image.convert("LA")
+        gray_image = _grayscale(image)
         byte_arr = io.BytesIO()
         gray_image.save(byte_arr, format=image.format)
-        logger.info("Successfully converted image to grayscale")
+        logger.debug("Successfully converted image to grayscale")
         return byte_arr.getvalue()
     except UnidentifiedImageError as e:
-        logger.error(f"Error converting image to grayscale: {e}")
+        logger.error("Error converting image to grayscale: %s", e)
         return image_data
 
 
@@ -234,5 +534,39 @@ async def convert_to_grayscale_async(image_data):
     :rtype: bytes
     """
     loop = asyncio.get_running_loop()
-    with ThreadPoolExecutor() as pool:
-        return await loop.run_in_executor(pool, convert_to_grayscale, image_data)
+    return await loop.run_in_executor(_GRAY_POOL, convert_to_grayscale, image_data)
+
+
+def convert_and_save_grayscale(image_data, filepath):
+    """
+    Convert image data to grayscale and write the result straight to a file.
+
+    Pillow encodes directly into the destination file, so the grayscale bytes
+    never make an extra round-trip through Python buffers.
+
+    :param image_data: Original image data
+    :type image_data: bytes
+    :param filepath: Path to save the grayscale image
+    :type filepath: str
+    """
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        _grayscale(image).save(filepath)
+        logger.debug("Successfully saved grayscale image to %s", filepath)
+    except (UnidentifiedImageError, OSError) as e:
+        logger.error("Error converting image for %s: %s", filepath, e)
+        with open(filepath, "wb") as file:  # Fall back to saving the original image
+            file.write(image_data)
+
+
+async def convert_and_save_grayscale_async(image_data, filepath):
+    """
+    Convert image data to grayscale and save it to a file asynchronously.
+
+    :param image_data: Original image data
+    :type image_data: bytes
+    :param filepath: Path to save the grayscale image
+    :type filepath: str
+    """
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_GRAY_POOL, convert_and_save_grayscale, image_data, filepath)